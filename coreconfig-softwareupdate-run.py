@@ -1,11 +1,12 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 ###################################################################
 #
 # This script provides a deferral and enforcement mechanism for 
 # software updates. If updates are available which don't require
-# a restart, they are installed silently in the background. If critical 
+# a restart, they are installed silently in the background (as long as
+# someone is logged in, or it is quiet hours - see below). If critical 
 # updates are found which do require a restart, the user is nagged to 
 # install them and given the option to defer for up to DEFER_LIMIT
 # days. DEFER_LIMIT can be set as ${4} in the JSS.
@@ -22,6 +23,10 @@
 # or honoured if we install at the login window, but the install will only
 # proceed if the hour is between QUIET_HOURS_START and QUIET_HOURS_END   
 #
+# If nobody is at the console and it is outside quiet hours, we exit
+# straight away without checking for updates - not even those which
+# don't need a restart. They'll be picked up by a later run.
+#
 # Date: @@DATE
 # Version: @@VERSION
 # Origin: @@ORIGIN
@@ -29,15 +34,11 @@
 #
 ##################################################################
 
+# Anything else is imported where it's used, so that
+# runs which exit early don't pay to load it.
 import os
 import sys
 import subprocess
-import plistlib
-import datetime
-import thread
-from time import sleep
-from threading import Timer
-from SystemConfiguration import SCDynamicStoreCopyConsoleUser
 
 SWUPDATE = '/usr/sbin/softwareupdate'
 PLISTBUDDY = '/usr/libexec/PlistBuddy'
@@ -47,9 +48,53 @@ TRIGGERFILE = '/var/db/.AppleLaunchSoftwareUpdate'
 OPTIONSFILE = '/var/db/.SoftwareUpdateOptions'
 DEFER_FILE = '/var/db/UoESoftwareUpdateDeferral'
 QUICKADD_LOCK = '/var/run/UoEQuickAddRunning'
+CACHE_FILE = '/var/db/UoESoftwareUpdateListCache'
+CACHE_TTL = 30 # minutes
+CACHE_WATCH_PATHS = ['/var/db/receipts', '/Library/Receipts', '/var/db/.SoftwareUpdateAtLogout', INDEX]
 NO_NETWORK_MSG = "Can't connect to the Apple Software Update server, because you are not connected to the Internet."
 SWUPDATE_PROCESSES = ['softwareupdated', 'swhelperd', 'softwareupdate_notify_agent', 'softwareupdate_download_service']
+SWUPDATED_PLIST = '/System/Library/LaunchDaemons/com.apple.softwareupdated.plist'
 HELPER_AGENT = '/Library/LaunchAgents/uk.ac.ed.mdp.jamfhelper-swupdate.plist'
+SWUPDATE_ICON = '/System/Library/CoreServices/Software Update.app/Contents/Resources/SoftwareUpdate.icns'
+JH_DEFER_PREFIX = ( JAMFHELPER,
+                    '-windowType', 'utility',
+                    '-title', 'UoE Mac Supported Desktop',
+                    '-heading', 'Software Update Available',
+                    '-icon', SWUPDATE_ICON,
+                    '-timeout', '99999' )
+JH_DEFER_DESC = ( "One or more software updates require a restart:\n\n{}\n\n"
+                  "Updates must be applied regularly.\n\n"
+                  "You will be required to restart after:\n{}." )
+JH_FORCE_PREFIX = ( JAMFHELPER,
+                    '-windowType', 'utility',
+                    '-title', 'UoE Mac Supported Desktop',
+                    '-heading', 'Mandatory Restart Required',
+                    '-icon', SWUPDATE_ICON,
+                    '-timeout', '99999' )
+JH_FORCE_DESC = ( "One or more updates which require a restart have been deferred "
+                  "for the maximum allowable time:\n\n{}\n\n"
+                  "A restart is now mandatory.\n\n"
+                  "Please save your work and restart now to install the update." )
+LIBSYSTEM = '/usr/lib/libSystem.dylib'
+UTMPX_USER_PROCESS = 7
+# Power source and (laptops only) charge level from 'pmset -g batt'
+PMSET_BATT_RE = r"'(AC|Battery) Power'(?:.*?(\d+)%)?"
+
+def read_plist(path):
+    # Handles both XML and binary plists
+    import plistlib
+    with open(path, 'rb') as f:
+        return plistlib.load(f)
+
+def write_plist(contents, path):
+    with open(path, 'wb') as f:
+        dump_plist(contents, f)
+
+def dump_plist(contents, f):
+    # Binary plists are smaller and much
+    # quicker to parse than XML
+    import plistlib
+    plistlib.dump(contents, f, fmt=plistlib.FMT_BINARY)
 
 def get_args():
     try:
@@ -59,36 +104,45 @@ def get_args():
                  'MIN_BATTERY_LEVEL': int(sys.argv[7])
         }
     except ValueError:
-        print "You need to specify DEFER_LIMIT, QUIET_HOURS_START, QUIET_HOURS_AND and MIN_BATTERY_LEVEL as integers"
+        print("You need to specify DEFER_LIMIT, QUIET_HOURS_START, QUIET_HOURS_AND and MIN_BATTERY_LEVEL as integers")
         raise
     return args
     
 def process_updates(args):
-    # Don't run if the quickadd package is still doing its stuff
-    if os.path.exists(QUICKADD_LOCK):
-        print "QuickAdd package appears to be running - will exit"
+    # If nobody is at the console and we're outside quiet hours
+    # there's nothing we can usefully do, so don't wait on the
+    # (slow) softwareupdate check to find that out.
+    if ( console_user() is None and
+         not is_quiet_hours(args['QUIET_HOURS_START'], args['QUIET_HOURS_END'])):
+        print("Nobody is logged in and we are not in quiet hours - will exit")
         sys.exit(0)
     
     # Check for updates - we stash the result so that
     # we minimise the number of times we have to run the
     # softwareupdate command - it's slow.
     try: 
-        list = get_update_list()
+        # The model doesn't change, so find it out alongside
+        # the softwareupdate check rather than after it
+        sysctl_proc = start_cmd(['sysctl', 'hw.model'])
+
+        updates = parse_update_list(get_and_download_updates())
      
-        if updates_available(list):
-            download_updates()
-            if restart_required(list):
-                if console_user(): 
+        if updates['has_updates']:
+            if updates['has_restart']:
+                # Look again - the check can take several minutes,
+                # and the user may have logged out in the meantime
+                user = console_user()
+                if user: 
                     # User is logged in - ask if they want to defer
                     max_defer_date = deferral_ok_until(args['DEFER_LIMIT'])
                     if max_defer_date != False:
-                        if not user_wants_to_defer(max_defer_date, printable_updates(list)):
+                        if not user_wants_to_defer(max_defer_date, updates['printable']):
                             # Users doesn't want to defer, so set
                             # thing up to install update, and force
                             # logout.
                             prep_index_for_logout_install()
                             force_update_on_logout()
-                            friendly_logout()
+                            friendly_logout(user)
                         else:
                             sys.exit(0)
                     else:
@@ -96,59 +150,72 @@ def process_updates(args):
                         # so require a logout
                         prep_index_for_logout_install()
                         force_update_on_logout()
-                        force_logout(printable_updates(list))
+                        force_logout(updates['printable'], user)
                 elif ( nobody_logged_in() and
                        is_quiet_hours(args['QUIET_HOURS_START'], args['QUIET_HOURS_END'])):
-                    print "Nobody is logged in and we are in quiet hours - starting unattended install..."
-                    unattended_install(min_battery=args['MIN_BATTERY_LEVEL'])
+                    print("Nobody is logged in and we are in quiet hours - starting unattended install...")
+                    # Check the power situation right before installing -
+                    # it may have changed while we were downloading
+                    batt = subprocess.check_output(['pmset', '-g', 'batt'],
+                                                   universal_newlines=True)
+                    unattended_install(min_battery=args['MIN_BATTERY_LEVEL'],
+                                       batt=batt,
+                                       model=cmd_output(sysctl_proc))
                 else:
-                    print ( "Updates require a restart but someone is logged in remotely "
-                            "or we are not in quiet hours - aborting" )
+                    print("Updates require a restart but someone is logged in remotely "
+                          "or we are not in quiet hours - aborting")
                     sys.exit(0)
             else:
                 # Updates are available, but they don't
                 # require a restart - just install them
-                print "Installing updates which don't require a restart"
+                print("Installing updates which don't require a restart")
                 install_recommended_updates()
                 # and remove the deferral tracking file
                 remove_deferral_tracking_file()
                 sys.exit(0)
         else:
-            print "No Updates"
+            print("No Updates")
             remove_deferral_tracking_file()
             sys.exit(0)
     except KeyboardInterrupt:
         # If any of the softwareupdate commands times out
         # we receive a KeyboardInterrupt
-        print "Command timed out: giving up!"
+        print("Command timed out: giving up!")
         sys.exit(255)
 
 
 def cmd_with_timeout(cmd, timeout):
-    # Run a command, kill it and throw an Exception
-    # in the main thread if it doesn't complete
-    # within <timeout> seconds.
-    # stdout and stderr will be returned together.
-    
-    def kill_proc(p):
-        p.kill()
-        # The timer is running in a separate thread, so
-        # use interrupt_main() to throw a KeyboardInterrupt
-        # back in the main thread.
-        thread.interrupt_main() 
-  
-    _proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    my_timer = Timer(timeout, kill_proc, [_proc])
-
+    # Run a command, kill it and throw a KeyboardInterrupt
+    # if it doesn't complete within <timeout> seconds.
+    # stdout and stderr will be returned together,
+    # along with the exit status.
+    _proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
     try:
-        my_timer.start()
-        stdout = _proc.communicate()
-        return stdout
-    finally:
-        my_timer.cancel()
+        output = _proc.communicate(timeout=timeout)[0]
+        return (output, _proc.returncode)
+    except subprocess.TimeoutExpired:
+        _proc.kill()
+        _proc.wait()
+        raise KeyboardInterrupt()
+
+
+def start_cmd(cmd):
+    # Start a command without waiting for it, so
+    # that several can run at the same time. Use
+    # cmd_output() to collect what it printed.
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+
+def cmd_output(proc):
+    # Wait for a command started with start_cmd()
+    # and return its stdout
+    return proc.communicate()[0]
 
 
 def is_quiet_hours(start, end):
+    import datetime
     now_hour = datetime.datetime.now().hour
     if (start < end):
         return start <= now_hour < end
@@ -157,17 +224,19 @@ def is_quiet_hours(start, end):
         return (start <= now_hour) or (now_hour < end)
         
       
-def unattended_install(min_battery):
+def unattended_install(min_battery, batt, model):
     # Do a bunch of safety checks and if all is OK,
     # try to install updates unattended
     # Safety checks here?
-    if (using_ac_power() and min_battery_level(min_battery)):  
+    # batt and model are the output of 'pmset -g batt'
+    # and 'sysctl hw.model' respectively.
+    if (using_ac_power(batt) and min_battery_level(min_battery, batt, model)):  
         lock_out_loginwindow()
         install_recommended_updates()
         # We should make this authenticated...
         unauthenticated_reboot()
     else:
-        print "Power conditions were unacceptable for unattended installation."
+        print("Power conditions were unacceptable for unattended installation.")
 
 def unauthenticated_reboot():
     # Will bring us back to firmware login screen
@@ -184,14 +253,14 @@ def create_lgwindow_launchagent():
                  "ProgramArguments": [ JAMFHELPER,
                                        '-windowType', 'fs',
                                        '-heading', 'Installing macOS updates...',
-                                       '-icon', '/System/Library/CoreServices/Software Update.app/Contents/Resources/SoftwareUpdate.icns',
+                                       '-icon', SWUPDATE_ICON,
                                        '-description', 'Please do not turn off this computer.' ],
                  "RunAtLoad": True,
                  "keepAlive": True
                  }   
 
     # Just overwrite it if it's already there
-    plistlib.writePlist(contents, HELPER_AGENT)
+    write_plist(contents, HELPER_AGENT)
                                        
 def lock_out_loginwindow():
     # Make sure our agent exists
@@ -201,167 +270,330 @@ def lock_out_loginwindow():
                            '-F', '-S', 'LoginWindow',
                            HELPER_AGENT ])
     
-def get_update_list():
-    print "Checking for updates"
-    
-    # Get all recommended updates
-    list = cmd_with_timeout([ SWUPDATE, '-l', '-r' ], 180)
-    return list[0].split("\n")
-
-def printable_updates(list):
-    """ Return a printable list of available updates """
-    return "\n".join([ a.split(',')[0] for a in list if '[restart]' in a ])
-
-def download_updates():
-    print "Downloading updates"
-    # Download applicable updates
-    cmd_with_timeout([ SWUPDATE, '-d', '-r' ], 600)
+def get_and_download_updates():
+    # Reuse a recent result if we have one - softwareupdate
+    # has to contact Apple's servers, which is slow. The
+    # updates will have been downloaded when it was cached.
+    cached = read_update_list_cache()
+    if cached is not None:
+        print("Using cached softwareupdate output")
+        return cached
+
+    print("Checking for and downloading updates")
     
+    # List and download all recommended updates in one go,
+    # so that we only talk to the update server once
+    output, status = cmd_with_timeout([ SWUPDATE, '-l', '-d', '-r' ], 780)
+    # Only cache a clean run - if the download failed
+    # or we couldn't reach the update server, try again
+    # next time.
+    if status == 0 and NO_NETWORK_MSG not in output:
+        write_update_list_cache(output)
+    return output
+
+def parse_update_list(raw):
+    """ Work out from the output of softwareupdate whether there
+        are any updates, whether any need a restart, and a printable
+        list of those which do - all in a single pass. """
+    has_updates = True
+    has_restart = False
+    restart_lines = []
+    for line in raw.splitlines():
+        if 'No new software available.' in line or NO_NETWORK_MSG in line:
+            has_updates = False
+        if '[restart]' in line:
+            has_restart = True
+            restart_lines.append(line.split(',', 1)[0])
+    return { 'has_updates': has_updates,
+             'has_restart': has_restart,
+             'printable': "\n".join(restart_lines) }
+
+def watched_mtimes():
+    # Modification times of the paths which change when
+    # updates are installed, so that a stale cache is spotted.
+    mtimes = []
+    for path in CACHE_WATCH_PATHS:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(0)
+    return mtimes
+
+def read_update_list_cache():
+    # Returns the cached softwareupdate output, or None if
+    # there is no cache or it is out of date
+    import datetime
+    try:
+        cache = read_plist(CACHE_FILE)
+        age = datetime.datetime.now() - cache['timestamp']
+        # A timestamp in the future means the clock has
+        # been wrong at some point - don't trust it
+        if not datetime.timedelta(0) <= age < datetime.timedelta(minutes=CACHE_TTL):
+            return None
+        if cache['checksum_of_receipts'] != watched_mtimes():
+            return None
+        return cache['output']
+    except Exception:
+        # Missing or unreadable cache - just check again
+        return None
+
+def write_update_list_cache(output):
+    import datetime
+    cache = { 'timestamp': datetime.datetime.now(),
+              'output': output,
+              'checksum_of_receipts': watched_mtimes() }
+    write_plist(cache, CACHE_FILE)
+
+def invalidate_update_list_cache():
+    try:
+        os.remove(CACHE_FILE)
+    except OSError:
+        pass
+
 def prep_index_for_logout_install():
     # The ProductPaths key of the index file
     # will contain the names of all the downloaded
     # updates - set them all up to install on logout.
-    swindex = plistlib.readPlist(INDEX)
+    swindex = read_plist(INDEX)
 
     # Clean up our index
-    print "Setting up the updates index file"
+    print("Setting up the updates index file")
     swindex['InstallAtLogout'] = []
 
     for product in swindex['ProductPaths'].keys():
-        print "Setting up {} to install at logout".format(product)
+        print("Setting up {} to install at logout".format(product))
         swindex['InstallAtLogout'].append(product)
 
-    plistlib.writePlist(swindex, INDEX)
+    write_plist(swindex, INDEX)
 
     
 def force_update_on_logout():
-    print "Setting updates to run on logout"
+    from time import sleep
+    print("Setting updates to run on logout")
 
     # Write options into a hidden plist
     options = {'-RootInstallMode': 'YES', '-SkipConfirm': 'YES'}
-    plistlib.writePlist(options, OPTIONSFILE)
+    write_plist(options, OPTIONSFILE)
     
     # Touch the magic trigger file
     with open(TRIGGERFILE, 'w'):
         pass
+
+    # The updates will be installed at logout, so
+    # the cached list won't be true for much longer
+    invalidate_update_list_cache()
     
     # Kick the various daemons belonging to the softwareupdate 
     # mechanism. This seems to be necesaary to get Software Update
-    # to realise that the needed updates have been downloaded 
-    for process in SWUPDATE_PROCESSES:
-        err = subprocess.call([ 'killall', '-HUP', process ], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    sleep(5) 
+    # to realise that the needed updates have been downloaded.
+    # killall takes several names, so do them all at once.
+    if not os.path.exists(SWUPDATED_PLIST):
+        # Nothing to kick, so nothing to wait for
+        return
+    before = index_mtime()
+    err = subprocess.call([ 'killall', '-HUP' ] + SWUPDATE_PROCESSES, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Give them up to 5 seconds to notice - they rewrite
+    # the index when they do, so stop waiting once it changes.
+    for _ in range(50):
+        sleep(0.1)
+        if index_mtime() != before:
+            break
+
+
+def index_mtime():
+    try:
+        return os.stat(INDEX).st_mtime
+    except OSError:
+        return None
      
 
 def deferral_ok_until(limit):
+    import datetime
     now = datetime.datetime.now()
 
-    if os.path.exists(DEFER_FILE):
+    try:
         # Read deferral date
-        df = plistlib.readPlist(DEFER_FILE)
-        ok_until = df['DeferOkUntil']
-        if now < ok_until:
-            print "OK to defer until {}".format(ok_until)
-            return ok_until
-        else:
-            print "Not OK to defer ({}) is in the past".format(ok_until)
-            return False
-    else:
+        df = read_plist(DEFER_FILE)
+    except FileNotFoundError:
         # Create the file, and write into it
         limit = datetime.timedelta(days = int(limit) )
         defer_date = now + limit
-        plist = { 'DeferOkUntil': defer_date }
-        plistlib.writePlist(plist, DEFER_FILE)
-        print "Created deferral file - Ok to defer until {}".format(defer_date)
-        return defer_date
+        if create_deferral_file(defer_date):
+            print("Created deferral file - Ok to defer until {}".format(defer_date))
+            return defer_date
+        # Another run created it first - go with its date
+        df = read_plist(DEFER_FILE)
+
+    ok_until = df['DeferOkUntil']
+    if now < ok_until:
+        print("OK to defer until {}".format(ok_until))
+        return ok_until
+    else:
+        print("Not OK to defer ({}) is in the past".format(ok_until))
+        return False
+
+def create_deferral_file(defer_date):
+    # Write the deferral file only if it doesn't already exist.
+    # It's written to a temporary file first and then linked into
+    # place, which fails if another run has got there first.
+    # Returns False in that case.
+    import tempfile
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(DEFER_FILE), delete=False)
+    try:
+        with tmp:
+            dump_plist({ 'DeferOkUntil': defer_date }, tmp)
+        # NamedTemporaryFile is 0600 - keep the usual permissions
+        os.chmod(tmp.name, 0o644)
+        os.link(tmp.name, DEFER_FILE)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp.name)
 
 def user_wants_to_defer(defer_until, updates):
-    answer = subprocess.call([ JAMFHELPER,
-                              '-windowType', 'utility',
-                              '-title', 'UoE Mac Supported Desktop',
-                              '-heading', 'Software Update Available',
-                              '-icon', '/System/Library/CoreServices/Software Update.app/Contents/Resources/SoftwareUpdate.icns',
-                              '-timeout', '99999',
-                              '-description', "One or more software updates require a restart:\n\n%s\n\nUpdates must be applied regularly.\n\nYou will be required to restart after:\n%s." % (updates, defer_until.strftime( "%a, %d %b %H:%M:%S")),
-                              '-button1', 'Restart now',
-                               '-button2', 'Restart later' ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    desc = JH_DEFER_DESC.format(updates, defer_until.strftime("%a, %d %b %H:%M:%S"))
+    argv = list(JH_DEFER_PREFIX) + [ '-description', desc,
+                                     '-button1', 'Restart now',
+                                     '-button2', 'Restart later' ]
+    answer = subprocess.call(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if answer == 2: # 0 = now, 2 = defer
-        print "User elected to defer update"
+        print("User elected to defer update")
         return True
     else:
-        print "User permitted immediate update"
+        print("User permitted immediate update")
         return False
         
-def force_logout(updates):
-    answer = subprocess.call([ JAMFHELPER,
-                              '-windowType', 'utility',
-                              '-title', 'UoE Mac Supported Desktop',
-                              '-heading', 'Mandatory Restart Required',
-                              '-icon', '/System/Library/CoreServices/Software Update.app/Contents/Resources/SoftwareUpdate.icns',
-                              '-timeout', '99999',
-                              '-description', "One or more updates which require a restart have been deferred for the maximum allowable time:\n\n%s\n\nA restart is now mandatory.\n\nPlease save your work and restart now to install the update." % updates,
-                              '-button1', 'Restart now' ])
-    friendly_logout()
+def force_logout(updates, user):
+    argv = list(JH_FORCE_PREFIX) + [ '-description', JH_FORCE_DESC.format(updates),
+                                     '-button1', 'Restart now' ]
+    answer = subprocess.call(argv)
+    friendly_logout(user)
 
 def remove_deferral_tracking_file():
-    if os.path.exists(DEFER_FILE):
+    try:
         os.remove(DEFER_FILE)
-        print "Removed deferral tracking file"
+    except OSError:
+        # Nothing to remove
+        return
+    print("Removed deferral tracking file")
+    invalidate_update_list_cache()
     
 
 def console_user():
+    try:
+        from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+    except ImportError:
+        # This python3 has no PyObjC (e.g. the Command Line Tools one),
+        # so ask who owns the console instead. It's owned by root
+        # while the login window is showing.
+        username = subprocess.check_output(['stat', '-f%Su', '/dev/console'],
+                                           universal_newlines=True).strip()
+        return [username, None][username in ["root", ""]]
     username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]
     username = [username, None][username in [u"loginwindow", None, u""]]
     return username
 
 
 def nobody_logged_in():
-    # If the 'w' command only returns 2 lines of output
-    # the nobody is on the console or a tty
+    # Nobody should be on the console or a tty
     # also check console user for belt and braces
-    return ( len(subprocess.check_output(['w']).strip().split("\n")) < 3 and
+    try:
+        sessions = login_sessions()
+    except (OSError, AttributeError):
+        # Couldn't read utmpx - if the 'w' command only
+        # returns 2 lines of output then nobody is logged in
+        w_output = subprocess.check_output(['w'], universal_newlines=True)
+        sessions = len(w_output.strip().split("\n")) - 2
+    return ( sessions <= 0 and
              console_user() == None )
+
+
+def login_sessions():
+    # Count the user sessions in the utmpx database - this
+    # is where 'w' gets them from, but saves running it.
+    import ctypes
+
+    class Timeval(ctypes.Structure):
+        _fields_ = [ ('tv_sec', ctypes.c_long),
+                     ('tv_usec', ctypes.c_int32) ]
+
+    class Utmpx(ctypes.Structure):
+        _fields_ = [ ('ut_user', ctypes.c_char * 256),
+                     ('ut_id', ctypes.c_char * 4),
+                     ('ut_line', ctypes.c_char * 32),
+                     ('ut_pid', ctypes.c_int32),
+                     ('ut_type', ctypes.c_short),
+                     ('ut_tv', Timeval),
+                     ('ut_host', ctypes.c_char * 256),
+                     ('ut_pad', ctypes.c_uint32 * 16) ]
+
+    libc = ctypes.CDLL(LIBSYSTEM)
+    libc.getutxent.restype = ctypes.POINTER(Utmpx)
+
+    sessions = 0
+    libc.setutxent()
+    try:
+        while True:
+            entry = libc.getutxent()
+            if not entry:
+                break
+            if entry.contents.ut_type == UTMPX_USER_PROCESS:
+                sessions += 1
+    finally:
+        libc.endutxent()
+    return sessions
         
     
-def friendly_logout():
-    user = console_user()
+def friendly_logout(user):
     subprocess.call([ 'sudo', '-u', user, 'osascript', '-e', u'tell application "loginwindow" to  «event aevtrlgo»' ])
 
-def restart_required(updates):
-    return any('[restart]' in a for a in updates)
-
-def updates_available(updates):
-    # Returns True if there are not no updates :)
-    return not ( 'No new software available.' in updates or
-                 NO_NETWORK_MSG in updates)
-                 
 def install_recommended_updates():
     # An hour should be sufficient to install
     # updates, hopefully! 
     cmd_with_timeout([ SWUPDATE, '-i', '-r' ], 3600)
-
-def min_battery_level(min):
-    if is_a_laptop():
-        try:
-            level = subprocess.check_output(['pmset', '-g', 'batt']).split("\t")[1].split(';')[0][:-1]
-            print "Battery level: {}".format(level)
-            return int(level) >= min
-        except (IndexError, ValueError):
+    # What's available will have changed
+    invalidate_update_list_cache()
+
+def parse_pmset_batt(batt):
+    # Returns the power source ('AC' or 'Battery') and the
+    # battery level from the output of 'pmset -g batt'.
+    # Either will be None if it can't be found - desktops
+    # have no battery level.
+    import re
+    match = re.search(PMSET_BATT_RE, batt, re.S)
+    if not match:
+        return None, None
+    level = match.group(2)
+    return match.group(1), (int(level) if level else None)
+
+def min_battery_level(min, batt, model):
+    if is_a_laptop(model):
+        level = parse_pmset_batt(batt)[1]
+        if level is None:
             # Couldn't get battery level - play it safe
-            print "Failed to get battery level"
+            print("Failed to get battery level")
             return False
+        print("Battery level: {}".format(level))
+        return level >= min
     else:
-        print "Not a laptop."
+        print("Not a laptop.")
 
-def using_ac_power():
-    source = subprocess.check_output(['pmset', '-g', 'batt']).split("\t")[0].split(" ")[3][1:]
-    print "Power source is: {}".format(source)
+def using_ac_power(batt):
+    source = parse_pmset_batt(batt)[0]
+    print("Power source is: {}".format(source))
     return source == 'AC'
 
-def is_a_laptop():
-    return subprocess.check_output(['sysctl', 'hw.model']).find('MacBook') > 0
+def is_a_laptop(model):
+    return model.find('MacBook') > 0
     
 if __name__ == "__main__":
+    # Don't run if the quickadd package is still doing its stuff
+    if os.path.exists(QUICKADD_LOCK):
+        print("QuickAdd package appears to be running - will exit")
+        sys.exit(0)
+
     args = get_args()
     process_updates(args)
 